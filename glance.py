@@ -27,15 +27,16 @@
 
 import os, sys, json, requests, textwrap, traceback, ckanapi
 
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta, date, time, timezone
 from dateutil import parser
 from dateutil.easter import * # pip install python-dateutil
 from calendar import monthrange
 
-from copy import copy
-
 import watchdog
 from notify import send_to_slack
+from watchdog_util.catalog import fetch_packages
+from watchdog_util.schedule import publishing_periods, local_timezone
+from watchdog_util.shards import parse_shard, in_shard, store_shard, load_shards
 
 from pprint import pprint
 try:
@@ -43,26 +44,26 @@ try:
 except ImportError:  # Graceful fallback if IceCream isn't installed.
     ic = lambda *a: None if not a else (a[0] if len(a) == 1 else a)  # noqa
 
-def get_archive_path():
+def get_archive_path(filename='last_scan.json'):
     # Change path to script's path for cron job.
     abspath = os.path.abspath(__file__)
     dname = os.path.dirname(abspath)
     os.chdir(dname)
-    last_scan_file = dname+'/last_scan.json'
+    last_scan_file = dname+'/'+filename
     return last_scan_file
 
-def store_as_json(output):
-    last_scan_file = get_archive_path()
+def store_as_json(output,filename='last_scan.json'):
+    last_scan_file = get_archive_path(filename)
     with open(last_scan_file, 'w') as f:
         json.dump(output, f, ensure_ascii=True, indent = 4)
 
-def load_from_json():
-    last_scan_file = get_archive_path()
+def load_from_json(filename='last_scan.json',default=None):
+    last_scan_file = get_archive_path(filename)
     if os.path.exists(last_scan_file):
         with open(last_scan_file, 'r') as f:
             return json.load(f)
     else:
-        return []
+        return [] if default is None else default
 
 def get_terminal_size():
     rows, columns = os.popen('stty size', 'r').read().split()
@@ -153,6 +154,23 @@ def infer_upload_method(package):
             # This package is probably all manually uploaded data.
     return loading_method
 
+def localize(dt):
+    """Treat a datetime without a time zone as local time."""
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=local_timezone)
+    return dt
+
+def parse_ckan_timestamp(timestamp):
+    """Convert a CKAN timestamp (like '2014-01-07T15:27:45.123456', which is
+    in UTC) to a timezone-aware datetime."""
+    try:
+        dt = datetime.fromisoformat(timestamp)
+    except ValueError:
+        dt = parser.parse(timestamp)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
 def temporal_coverage_end(package):
     """Returns a string representing the end date (or None)."""
     if 'extras' not in package:
@@ -181,6 +199,49 @@ def temporal_coverage_end(package):
         return end_date
     return None
 
+def load_coverage_summary(site, API_key=None):
+    """Read the coverage summary table published by watchdog (with as few
+    datastore_search requests as possible) and return its rows grouped by
+    package ID. If no summary table is configured or it can't be read, an empty
+    dict is returned, so that the packages' own temporal_coverage values get
+    used instead."""
+    try:
+        from credentials import coverage_summary_resource_id
+    except ImportError:
+        return {}
+    ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
+    rows = []
+    try:
+        while True:
+            response = ckan.action.datastore_search(id=coverage_summary_resource_id, limit=32000, offset=len(rows)) # CKAN's maximum number of rows per request
+            rows += response['records']
+            if len(response['records']) == 0 or len(rows) >= response['total']:
+                break
+    except (ckanapi.errors.CKANAPIError, requests.exceptions.RequestException) as e:
+        print("Unable to load the coverage summary ({}: {}), so the packages' temporal_coverage values will be used.".format(type(e).__name__, e))
+        return {}
+    coverage_summary = {}
+    for row in rows:
+        coverage_summary.setdefault(row['package_id'], []).append(row)
+    return coverage_summary
+
+def summary_coverage_end(package, summary_rows):
+    """Returns the end date (as a string) of the package's temporal coverage,
+    as computed from its rows in the coverage summary, or None if it has none.
+    Rows for tables that are no longer in the package's time_field lookup (or
+    that were made with a different time field) are ignored."""
+    extras = {d['key']: d['value'] for d in package.get('extras', [])}
+    time_field_lookup = json.loads(extras.get('time_field', '{}'))
+    summary_rows = [row for row in summary_rows or [] if time_field_lookup.get(row['resource_id']) == row['time_field']]
+    if not summary_rows:
+        return None
+    ends = [localize(datetime.fromisoformat(row['max'])) for row in summary_rows]
+    if package.get('temporal_coverage_join_operator', 'union') == 'intersection':
+        end = min(ends)
+    else:
+        end = max(ends)
+    return end.astimezone(local_timezone).date().isoformat()
+
 def get_extensions(package):
     """Get from package metadata any known extensions to the publishing schedule, which are
     granted in cases where the the ETL job runs more frequently than the data typically
@@ -196,9 +257,8 @@ def get_extensions(package):
     'extra_time_in_days' field is used to construct an 'extra_time' field which is
     a timedelta.)
 
-    For now, the 'package_extensions' format will be used for compatibility with
-    the rest of pocket-watch, but eventually it will probably make sense to
-    switch to the resource-based 'extensions' format."""
+    The 'package_extensions' format is used for package-level lateness, while
+    the resource-based 'extensions' format is handled by get_resource_extensions()."""
 
     if 'extras' in package:
         extras_list = package['extras']
@@ -216,17 +276,68 @@ def get_extensions(package):
                 package_extensions['title'] = package['title']
             extensions = {package['id']: package_extensions}
             return extensions
-        #elif 'extensions' in extras:
-        #    extensions = json.loads(extras['extensions'])
-        #    assert type(extensions) == dict
-        #    for r_id, v in extensions.items():
-        #        if 'extra_time_in_days' in v:
-        #            v['extra_time'] = timedelta(v['extra_time_in_days'])
-        #    return extensions
-        # Note that the 'extensions' format is not consistent with the extensions
-        # format being used in compute_lateness().
     return {}
 
+def get_resource_extensions(package):
+    """Get from package metadata the 'extensions' field, which is a dict with keys
+    equal to the IDs of the resources that should be individually monitored for
+    staleness. Each value is a dict, which may contain an 'extra_time_in_days'
+    field (a float), which is used to construct an 'extra_time' field which is
+    a timedelta (as in get_extensions())."""
+    if 'extras' in package:
+        extras = {d['key']: d['value'] for d in package['extras']}
+        # Keep definitions and uses of extras metadata updated here:
+        # https://github.com/WPRDC/data-guide/blob/master/docs/metadata_extras.md
+        if 'extensions' in extras:
+            extensions = json.loads(extras['extensions'])
+            assert type(extensions) == dict
+            for r_id, v in extensions.items():
+                if 'extra_time_in_days' in v:
+                    v['extra_time'] = timedelta(v['extra_time_in_days'])
+            return extensions
+    return {}
+
+def build_resource_index(packages):
+    """Map the ID of each individually monitored resource to the resource itself,
+    the ID of its package, and its extension settings, so that resource-level
+    lateness can be computed from the package list without any more requests
+    to CKAN."""
+    resource_index = {}
+    for package in packages:
+        resource_extensions = get_resource_extensions(package)
+        for resource in package['resources']:
+            if resource['id'] in resource_extensions:
+                resource_index[resource['id']] = {'resource': resource,
+                    'package_id': package['id'],
+                    'extension': resource_extensions[resource['id']]}
+    return resource_index
+
+def compute_resource_lateness(resource, extension, publishing_period, no_updates_on=[]):
+    """Like compute_lateness(), but based on the resource's 'last_modified' field
+    (or 'created' field, for resources which have never been modified)."""
+    reference = resource.get('last_modified') or resource.get('created')
+    if reference is None:
+        return None
+    effective_reference_dt = account_for_gaps(parse_ckan_timestamp(reference), no_updates_on)
+    lateness = datetime.now(timezone.utc) - (effective_reference_dt + publishing_period)
+    if lateness.total_seconds() > 0 and 'yesterday' in no_updates_on:
+        lateness -= timedelta(days=1)
+    if 'extra_time' in extension:
+        lateness -= extension['extra_time']
+    return lateness
+
+def compute_resource_due_date(resource, extension, publishing_period, no_updates_on=[]):
+    """Like compute_due_date(), but for compute_resource_lateness()."""
+    reference = resource.get('last_modified') or resource.get('created')
+    if reference is None:
+        return None
+    due_dt = account_for_gaps(parse_ckan_timestamp(reference), no_updates_on) + publishing_period
+    if 'yesterday' in no_updates_on:
+        due_dt += timedelta(days=1)
+    if 'extra_time' in extension:
+        due_dt += extension['extra_time']
+    return due_dt
+
 def get_scheduled_gaps(package):
     """Get from package metadata any known exceptions to the publishing schedule. For datasets
     published 'daily', this can be a list like ['Sundays', 'holidays'].
@@ -323,14 +434,16 @@ def account_for_gaps(reference_dt, no_updates_on):
 
     # It might be a good idea to write another function to handle no_updates_on values
     # of 'yesterday'.
-    effective_reference_dt = copy(reference_dt)
+
+    # The days of the week should be those of the publisher's time zone.
+    effective_reference_dt = reference_dt.astimezone(local_timezone)
     while check_date(effective_reference_dt, no_updates_on):
         effective_reference_dt += timedelta(days=1)
     return effective_reference_dt
 
 def compute_lateness(extensions, package, package_id, publishing_period, reference_dt, no_updates_on=[]):
     effective_reference_dt = account_for_gaps(reference_dt, no_updates_on)
-    lateness = datetime.now() - (effective_reference_dt + publishing_period)
+    lateness = datetime.now(timezone.utc) - (effective_reference_dt + publishing_period)
     if lateness.total_seconds() > 0 and 'yesterday' in no_updates_on:
         lateness -= timedelta(days=1)
     if lateness.total_seconds() > 0 and package_id not in extensions:
@@ -343,146 +456,300 @@ def compute_lateness(extensions, package, package_id, publishing_period, referen
         lateness -= extensions[package_id]['extra_time']
     return lateness
 
-
-def main(mute_alerts=True, check_private_datasets=False, skip_watchdog=False, test_mode=False):
-    if not skip_watchdog:
-        watchdog.main(just_testing=False)
-    if False: # [ ] The code in this branch can be eliminated.
-        host = "data.wprdc.org"
-        url = "https://{}/api/3/action/current_package_list_with_resources?limit=999999".format(host)
-        r = requests.get(url)
-        response = r.json()
-        if not response['success']:
-            msg = "Unable to get the package list."
-            print(msg)
-            raise ValueError(msg)
-
-        packages = response['result']
+def compute_row_lateness(extensions, package, package_id, publishing_period, metadata_modified, package_probes, no_updates_on=[]):
+    """Returns the lateness of the rows of the package's tables, measured from the
+    last time watchdog saw their row counts or maximum _id values change, but only
+    if the package's metadata has been modified since then (so that packages whose
+    metadata gets updated without any new rows can be caught). Otherwise, None is
+    returned."""
+    changes = [localize(datetime.fromisoformat(p['rows_changed_at'])) for p in package_probes.values() if p.get('rows_changed_at') is not None]
+    if len(changes) == 0:
+        return None
+    last_rows_change = max(changes)
+    if metadata_modified <= last_rows_change:
+        return None
+    return compute_lateness(extensions, package, package_id, publishing_period, last_rows_change, no_updates_on)
+
+# Each route sends notifications about newly stale packages that match its
+# 'publisher' (the organization title), 'organization' (the organization name)
+# or 'tag' to a channel in a Slack group (which must have a webhook in
+# parameters.remote_parameters.webhook_by_group, unless it's 'wprdc').
+# The routes can be overridden by defining notification_routes in
+# parameters/remote_parameters.py.
+default_notification_routes = [
+    {'publisher': 'Allegheny County',
+    'channel': '#county-stale-datasets',
+    'slack_group': 'wprdc-and-friends'}
+    ]
+
+def get_notification_routes():
+    try:
+        from parameters.remote_parameters import notification_routes
+    except ImportError:
+        notification_routes = default_notification_routes
+    return notification_routes
+
+def compile_routing_index(routes):
+    """Turn the list of routes into a dict mapping (field, value) pairs (like
+    ('tag', '_etl')) to lists of (slack_group, channel) destinations, so that
+    each package can be routed with a few dict lookups."""
+    routing_index = {}
+    for route in routes:
+        destination = (route.get('slack_group', 'wprdc'), route['channel'])
+        for field in ['publisher', 'organization', 'tag']:
+            if field in route:
+                routing_index.setdefault((field, route[field]), []).append(destination)
+    return routing_index
+
+def route_stale_packages(newly_stale, routing_index, excluded_ids=[]):
+    """Returns a dict mapping each destination to the list of newly stale packages
+    that should be reported there."""
+    stale_by_destination = {}
+    for package_id, sp in newly_stale:
+        if package_id in excluded_ids:
+            continue
+        keys = [('publisher', sp['publisher']), ('organization', sp['organization'])] + [('tag', tag) for tag in sp['tags']]
+        destinations = set()
+        for key in keys:
+            destinations.update(routing_index.get(key, []))
+        for destination in destinations:
+            stale_by_destination.setdefault(destination, []).append(sp)
+    return stale_by_destination
+
+def build_destination_messages(stale_by_destination):
+    destination_messages = {}
+    for destination, stale_ones in stale_by_destination.items():
+        linked_stale_ones = ["<{}|{}>".format(sp['url'],sp['title']) for sp in stale_ones]
+        destination_messages[destination] = "Hey there! I just noticed {} newly stale {}: {}".format(len(linked_stale_ones),pluralize("dataset",linked_stale_ones,False), ', '.join(linked_stale_ones))
+    return destination_messages
+
+def send_destination_messages(destination_messages):
+    """Send the messages to their channels. Each Slack group gets its own thread,
+    so deliveries to different workspaces happen concurrently, while messages to
+    the same workspace are still sent one at a time."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    messages_by_group = {}
+    for (slack_group, channel), msg in destination_messages.items():
+        messages_by_group.setdefault(slack_group, []).append((channel, msg))
+
+    def send_to_group(slack_group):
+        for channel, msg in messages_by_group[slack_group]:
+            print("{} ({}): {}".format(channel, slack_group, msg))
+            try:
+                send_to_slack(msg,username='pocket watch',channel=channel,slack_group=slack_group)
+            except Exception as e:
+                print("Unable to send notification to {} in {}: {}".format(channel, slack_group, e))
+
+    if len(messages_by_group) > 0:
+        with ThreadPoolExecutor(max_workers=len(messages_by_group)) as executor:
+            list(executor.map(send_to_group, messages_by_group))
+
+def compute_due_date(extensions, package, package_id, publishing_period, reference_dt, no_updates_on=[]):
+    """Returns the datetime after which compute_lateness() will start reporting the
+    package as late, accounting for scheduled gaps and extensions."""
+    due_dt = account_for_gaps(reference_dt, no_updates_on) + publishing_period
+    if 'yesterday' in no_updates_on:
+        due_dt += timedelta(days=1)
+    if package_id not in extensions:
+        extensions = {**extensions, **get_extensions(package)}
+    if package_id in extensions and 'extra_time' in extensions[package_id]:
+        due_dt += extensions[package_id]['extra_time']
+    return due_dt
+
+due_index_file = 'due_index.json'
+due_dt_format = "%Y-%m-%dT%H:%M:%SZ" # A fixed-width format (always in UTC, which has no repeated hours) keeps the stored timestamps sortable as strings.
+
+def format_due_dt(dt):
+    return dt.astimezone(timezone.utc).strftime(due_dt_format)
+
+def local_due_dt(due):
+    """Convert a stored due date back to a local datetime, for printing."""
+    return datetime.strptime(due, due_dt_format).replace(tzinfo=timezone.utc).astimezone(local_timezone)
+
+def store_due_index(due_entries):
+    """Sort the due-date entries and store them (with the time the index was built)
+    so that forecast() can do range lookups without rescanning the catalog."""
+    due_entries = sorted(due_entries, key=lambda e: e['due'])
+    store_as_json({'built_at': format_due_dt(datetime.now(timezone.utc)), 'entries': due_entries}, due_index_file)
+
+def forecast(hours=24):
+    """List the packages that will become stale in the next [hours] hours, according
+    to the due-date index built by the last run of main()."""
+    from bisect import bisect_left, bisect_right
+    index = load_from_json(due_index_file, {})
+    if 'entries' not in index or not index['built_at'].endswith('Z'): # Older indices were stored in local time.
+        print("No up-to-date due-date index found. Run glance.py (without 'forecast') to build one.")
+        return []
+    entries = index['entries']
+    dues = [e['due'] for e in entries]
+    now = datetime.now(timezone.utc)
+    start = bisect_left(dues, format_due_dt(now))
+    end = bisect_right(dues, format_due_dt(now + timedelta(hours=hours)))
+    upcoming = entries[start:end]
+
+    print("Due-date index built at {}.".format(local_due_dt(index['built_at'])))
+    print("{} becoming stale in the next {} hours:".format(pluralize("package",upcoming), hours))
+    for e in upcoming:
+        print("  {}  {} ({}, {}, based on {})".format(local_due_dt(e['due']).strftime("%Y-%m-%d %H:%M:%S %Z"), e['title'], e['publishing_frequency'], e['publisher'], e['basis']))
+    return upcoming
+
+
+# Some datasets are showing up as stale for one day because
+# (for instance) the County doesn't post jail census data
+# on a given day to their FTP server; our ETL script runs
+# but it doesn't update the metadata_modified.
+
+# One better solution to this would be to create a package-
+# (and maybe also resource-) level metadata field called
+# etl_job_last_ran.
+
+# [ ] These hard-coded exceptions can now be moved to package-level metadata.
+hardcoded_extensions = {}
+hardcoded_extensions['d15ca172-66df-4508-8562-5ec54498cfd4'] = {'title': 'Allegheny County Jail Daily Census',
+                'extra_time': timedelta(days=1),
+                'actual_data_source_reserve': timedelta(days=15)}
+hardcoded_extensions['046e5b6a-0f90-4f8e-8c16-14057fd8872e'] = {'title': 'Police Incident Blotter (30 Day)',
+                'extra_time': timedelta(days=1)}
+
+nonperiods = ['', 'As Needed', 'Not Updated (Historical Only)']
+
+def evaluate_package(i, package, extensions, probes, resource_index={}, coverage_summary={}):
+    """Evaluate the staleness of the i-th package (which must have a
+    'frequency_publishing' field), including the staleness of any of its
+    resources that are in the resource index. The end of the temporal coverage
+    is taken from the coverage summary if the package is in it.
+
+    Returns a record describing the package (with its 'stale' field set to
+    True if it's stale) and its entry for the due-date index, or (None, None)
+    if the package has no publishing period."""
+    period = publishing_periods
+    title = package['title']
+    package_id = package['id']
+    dataset_url = "https://data.wprdc.org/dataset/{}".format(package['name'])
+    metadata_modified = parse_ckan_timestamp(package['metadata_modified'])
+    publishing_frequency = package['frequency_publishing']
+    data_change_rate = package['frequency_data_change']
+    publisher = package['organization']['title']
+    private = package['private']
+    if private:
+        title = "(private) " + title
+
+    temporal_coverage_end_date = temporal_coverage_end(package) # Check for 'time_field' and auto-updated temporal_coverage field
+    if temporal_coverage_end_date is not None:
+        temporal_coverage_end_date = summary_coverage_end(package, coverage_summary.get(package_id)) or temporal_coverage_end_date
+
+    if publishing_frequency in period:
+        publishing_period = period[publishing_frequency]
     else:
-        from credentials import site, ckan_api_key as API_key
-        if not check_private_datasets:
-            API_key = None
-        ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
-        try:
-            packages = ckan.action.current_package_list_with_resources(limit=999999)
-        except:
-            packages = ckan.action.current_package_list_with_resources(limit=999999)
-
-
-    period = {'Annually': timedelta(days = 366),
-            'Bi-Annually': timedelta(days = 183),
-            'Quarterly': timedelta(days = 31+30+31),
-            'Bi-Monthly': timedelta(days = 31+30),
-            'Monthly': timedelta(days = 31),
-            'Bi-Weekly': timedelta(days = 14),
-            'Weekly': timedelta(days = 7), # 'Weekdays' could be another period, though it seems I'm coding exceptions into the no_updates_on metadata field.
-            'Daily': timedelta(days = 1),
-            'Hourly': timedelta(hours = 1),
-            'Multiple Times per Hour': timedelta(minutes=30)}
-
-
-    # Some datasets are showing up as stale for one day because
-    # (for instance) the County doesn't post jail census data
-    # on a given day to their FTP server; our ETL script runs
-    # but it doesn't update the metadata_modified.
-
-    # One better solution to this would be to create a package-
-    # (and maybe also resource-) level metadata field called
-    # etl_job_last_ran.
-
-    # [ ] These hard-coded exceptions can now be moved to package-level metadata.
-    extensions = {}
-    extensions['d15ca172-66df-4508-8562-5ec54498cfd4'] = {'title': 'Allegheny County Jail Daily Census',
-                    'extra_time': timedelta(days=1),
-                    'actual_data_source_reserve': timedelta(days=15)}
-    extensions['046e5b6a-0f90-4f8e-8c16-14057fd8872e'] = {'title': 'Police Incident Blotter (30 Day)',
-                    'extra_time': timedelta(days=1)}
-
-    nonperiods = ['', 'As Needed', 'Not Updated (Historical Only)']
-
-    packages_with_frequencies = 0
-    stale_count = 0
-    stale_packages = {}
-    for i,package in enumerate(packages):
-        if 'frequency_publishing' in package.keys():
-            title = package['title']
-            package_id = package['id']
-            dataset_url = "https://data.wprdc.org/dataset/{}".format(package['name'])
-            metadata_modified = datetime.strptime(package['metadata_modified'],"%Y-%m-%dT%H:%M:%S.%f")
-            publishing_frequency = package['frequency_publishing']
-            data_change_rate = package['frequency_data_change']
-            publisher = package['organization']['title']
-            private = package['private']
-            if private:
-                title = "(private) " + title
-
-            temporal_coverage_end_date = temporal_coverage_end(package) # Check for 'time_field' and auto-updated temporal_coverage field
-
-            if publishing_frequency in period:
-                publishing_period = period[publishing_frequency]
-            else:
-                publishing_period = None
-                if publishing_frequency not in nonperiods:
-                    raise ValueError("{}) {}: {} is not a known publishing frequency".format(k,title,publishing_frequency))
-            #print("{} ({}) was last modified {} (according to its metadata). {}".format(title,package_id,metadata_modified,package['frequency_publishing']))
-
-            if publishing_period is not None:
-                no_updates_on = get_scheduled_gaps(package)
-
-                lateness = compute_lateness(extensions, package, package_id, publishing_period, metadata_modified) # Include no_updates_on here if the ETL jobs
-                # get rescheduled to match actual data updates (rather than state update frequency).
-                if temporal_coverage_end_date is not None:
-                    temporal_coverage_end_dt = datetime.strptime(temporal_coverage_end_date, "%Y-%m-%d") + timedelta(days=1) # [ ] This has no time zone associated with it.
-                    # [ ] Change this to use parser.parse to allow times to be included, but also think more carefully about adding that offset.
-
-                    # Note that temporal_coverage_end_dt is advanced by one one day (to be the first day after the temporal coverage) and
-                    # also is technically a datetime but is actually just date information, with the time information thrown out.
-                    data_lateness = compute_lateness(extensions, package, package_id, publishing_period, temporal_coverage_end_dt, no_updates_on)
-                else:
-                    data_lateness = timedelta(seconds=0)
-
-
-                if lateness.total_seconds() > 0 or data_lateness.total_seconds() > 0: # Either kind of lateness triggers the listing of another stale package.
-                    stale_packages[package_id] = {
-                        'publishing_frequency': publishing_frequency,
-                        'data_change_rate': data_change_rate,
-                        'publisher': publisher,
-                        'json_index': i,
-                        'title': title,
-                        'package_id': package_id,
-                        'package_url': dataset_url,
-                        'upload_method': infer_upload_method(package),
-                        'url': dataset_url
-                        }
-                    if lateness.total_seconds() > 0:
-                        stale_packages[package_id]['cycles_late'] = lateness.total_seconds()/publishing_period.total_seconds()
-                        stale_packages[package_id]['last_modified'] = metadata_modified
-                        stale_packages[package_id]['days_late'] = lateness.total_seconds()/(60.0*60*24)
-                    else:
-                        stale_packages[package_id]['cycles_late'] = 0
-                        stale_packages[package_id]['last_modified'] = metadata_modified
-                        stale_packages[package_id]['days_late'] = 0.0
-
-                    #if temporal_coverage_end_date is not None:
-                    if data_lateness.total_seconds() > 0:
-                        stale_packages[package_id]['temporal_coverage_end'] = temporal_coverage_end_date # This is a string.
-                        stale_packages[package_id]['data_cycles_late'] = data_lateness.total_seconds()/publishing_period.total_seconds()
-
-                    # Describe the evidence that the package is stale.
-                    output = "{}) {} updates {}".format(i,title,package['frequency_publishing'])
-                    if lateness.total_seconds() > 0 and data_lateness.total_seconds() > 0:
-                        output += " but metadata_modified = {} and temporal_coverage_end_date = {} making it DOUBLE STALE!".format(metadata_modified,temporal_coverage_end_date)
-                    elif lateness.total_seconds() > 0:
-                        output += " but metadata_modified = {} making it STALE!".format(metadata_modified)
-                    elif data_lateness.total_seconds() > 0:
-                        output += " but temporal_coverage_end_date = {} making it STALE!".format(temporal_coverage_end_date)
-                    stale_packages[package_id]['output'] = output
-
-                    stale_count += 1
-            packages_with_frequencies += 1
-
-
-
+        publishing_period = None
+        if publishing_frequency not in nonperiods:
+            raise ValueError("{}) {}: {} is not a known publishing frequency".format(i,title,publishing_frequency))
+    #print("{} ({}) was last modified {} (according to its metadata). {}".format(title,package_id,metadata_modified,package['frequency_publishing']))
+
+    if publishing_period is None:
+        return None, None
+
+    no_updates_on = get_scheduled_gaps(package)
+
+    lateness = compute_lateness(extensions, package, package_id, publishing_period, metadata_modified) # Include no_updates_on here if the ETL jobs
+    # get rescheduled to match actual data updates (rather than state update frequency).
+    if temporal_coverage_end_date is not None:
+        # Note that temporal_coverage_end_dt is advanced by one one day (to be the first day after the temporal coverage) and
+        # is the local midnight at the start of that day, since the temporal coverage is just date information.
+        temporal_coverage_end_dt = datetime.combine(date.fromisoformat(temporal_coverage_end_date) + timedelta(days=1), time(), tzinfo=local_timezone)
+        data_lateness = compute_lateness(extensions, package, package_id, publishing_period, temporal_coverage_end_dt, no_updates_on)
+    else:
+        data_lateness = timedelta(seconds=0)
+
+    # Catch packages whose metadata gets updated even though no new rows
+    # are showing up in their tables.
+    row_lateness = compute_row_lateness(extensions, package, package_id, publishing_period, metadata_modified, probes.get(package_id, {}), no_updates_on)
+    no_new_rows = row_lateness is not None and row_lateness.total_seconds() > 0
+
+    stale_resources = []
+    resource_due_dts = []
+    for resource in package['resources']:
+        if resource['id'] in resource_index:
+            resource_lateness = compute_resource_lateness(resource, resource_index[resource['id']]['extension'], publishing_period, no_updates_on)
+            if resource_lateness is not None and resource_lateness.total_seconds() > 0:
+                stale_resources.append({'id': resource['id'],
+                    'name': resource.get('name', 'Unnamed resource'),
+                    'last_modified': resource.get('last_modified') or resource.get('created'),
+                    'cycles_late': resource_lateness.total_seconds()/publishing_period.total_seconds(),
+                    'days_late': resource_lateness.total_seconds()/(60.0*60*24)})
+            resource_due_dts.append(compute_resource_due_date(resource, resource_index[resource['id']]['extension'], publishing_period, no_updates_on))
+
+    # Record when this package will next go stale, whichever kind of lateness
+    # (of its metadata, its data, or one of its monitored resources) comes first.
+    due_dt = compute_due_date(extensions, package, package_id, publishing_period, metadata_modified)
+    basis = 'metadata_modified'
+    if temporal_coverage_end_date is not None:
+        data_due_dt = compute_due_date(extensions, package, package_id, publishing_period, temporal_coverage_end_dt, no_updates_on)
+        if data_due_dt < due_dt:
+            due_dt = data_due_dt
+            basis = 'temporal_coverage'
+    resource_due_dts = [dt for dt in resource_due_dts if dt is not None]
+    if len(resource_due_dts) > 0 and min(resource_due_dts) < due_dt:
+        due_dt = min(resource_due_dts)
+        basis = 'resource'
+    due_entry = {'due': format_due_dt(due_dt),
+        'id': package_id,
+        'title': title,
+        'publisher': publisher,
+        'publishing_frequency': publishing_frequency,
+        'basis': basis}
+
+    record = {
+        'publishing_frequency': publishing_frequency,
+        'data_change_rate': data_change_rate,
+        'publisher': publisher,
+        'organization': package['organization']['name'],
+        'tags': [td['name'] for td in package['tags']],
+        'json_index': i,
+        'title': title,
+        'package_id': package_id,
+        'package_url': dataset_url,
+        'upload_method': infer_upload_method(package),
+        'url': dataset_url,
+        'stale': lateness.total_seconds() > 0 or data_lateness.total_seconds() > 0 or no_new_rows or len(stale_resources) > 0 # Any kind of lateness makes the package stale.
+        }
+    if lateness.total_seconds() > 0:
+        record['cycles_late'] = lateness.total_seconds()/publishing_period.total_seconds()
+        record['last_modified'] = metadata_modified
+        record['days_late'] = lateness.total_seconds()/(60.0*60*24)
+    else:
+        record['cycles_late'] = 0
+        record['last_modified'] = metadata_modified
+        record['days_late'] = 0.0
+
+    #if temporal_coverage_end_date is not None:
+    if data_lateness.total_seconds() > 0:
+        record['temporal_coverage_end'] = temporal_coverage_end_date # This is a string.
+        record['data_cycles_late'] = data_lateness.total_seconds()/publishing_period.total_seconds()
+    record['no_new_rows'] = no_new_rows
+    record['stale_resources'] = stale_resources
+
+    if record['stale']:
+        # Describe the evidence that the package is stale.
+        output = "{}) {} updates {}".format(i,title,package['frequency_publishing'])
+        if lateness.total_seconds() > 0 and data_lateness.total_seconds() > 0:
+            output += " but metadata_modified = {} and temporal_coverage_end_date = {} making it DOUBLE STALE!".format(metadata_modified,temporal_coverage_end_date)
+        elif lateness.total_seconds() > 0:
+            output += " but metadata_modified = {} making it STALE!".format(metadata_modified)
+        elif data_lateness.total_seconds() > 0:
+            output += " but temporal_coverage_end_date = {} making it STALE!".format(temporal_coverage_end_date)
+        elif no_new_rows:
+            output += " and metadata_modified = {}, but the rows of its tables have not changed for {:.2f} cycles, making it STALE!".format(metadata_modified, row_lateness.total_seconds()/publishing_period.total_seconds())
+        elif len(stale_resources) > 0:
+            output += " and metadata_modified = {}, but {} ({}) {} not been updated, making it STALE!".format(metadata_modified, pluralize("resource",stale_resources), ', '.join(r['name'] for r in stale_resources), 'has' if len(stale_resources) == 1 else 'have')
+        record['output'] = output
+    return record, due_entry
+
+def report_staleness(stale_packages, due_entries, package_count, packages_with_frequencies, mute_alerts=True):
+    """Print the tables of stale packages, send notifications about the newly
+    stale ones, and store the list of stale packages and the due-date index."""
+    stale_count = len(stale_packages)
     # Sort stale packages by relative tardiness so the most recently tardy ones
     # appear at the bottom of the output and the most egregiously late ones
     # at the top.
@@ -506,7 +773,7 @@ def main(mute_alerts=True, check_private_datasets=False, skip_watchdog=False, te
         print("No datasets are stale by data-lateness.")
 
 
-    coda = "Out of {} packages, only {} have specified publication frequencies. {} are stale (past their refresh-by date), according to the metadata_modified field.".format(len(packages),packages_with_frequencies,stale_count)
+    coda = "Out of {} packages, only {} have specified publication frequencies. {} are stale (past their refresh-by date), according to the metadata_modified field.".format(package_count,packages_with_frequencies,stale_count)
     print(textwrap.fill(coda,70))
 
     # Store list of stale packages in a JSON file as a record of the last
@@ -537,34 +804,96 @@ def main(mute_alerts=True, check_private_datasets=False, skip_watchdog=False, te
         print(printable_msg)
         if not mute_alerts:
             send_to_slack(msg,username='pocket watch',channel='#stale-datasets',icon=':illuminati:')
-            #other_notifications = [
-            #    {'publisher': 'Allegheny County', 'medium': 'Slack',
-            #    'channel': '#county-stale-datasets',
-            #    'slack_group': 'wprdc-and-friends',
-            #    'slack-config': 'something'}
-            #    ]
-
-            #for other in other_notifications:
-            #    if other['publisher'] in [sp[1]['publisher'] for sp in newly_stale]:
-            #        publisher_stale_sets = []
-            #        for sp in newly_stale:
-            #            if other['publisher'] == sp[1]['publisher'] and sp[0] not in wprdc_datasets:
-            #                publisher_stale_sets.append(sp)
-
-            #        publisher_stale_ones = ["<{}|{}>".format(sp[1]['url'],sp[1]['title']) for sp in publisher_stale_sets]
-            #        if len(publisher_stale_ones) > 0:
-            #            printable_publisher_stale_ones = [sp[1]['title'] for sp in publisher_stale_sets]
-            #            multiple = len(publisher_stale_ones) != 1
-            #            publisher_msg = "Hey there! I just noticed {} newly stale {}: {}".format(len(publisher_stale_ones),pluralize("dataset",publisher_stale_ones,False), ', '.join(publisher_stale_ones))
-            #            #send_to_different_slack: wprdc-and-friends
-            #            print(publisher_msg)
-            #            send_to_slack(publisher_msg,username='pocket watch',channel='#county-stale-datasets',slack_group=other['slack_group'])
-            #            #send_to_slack(publisher_msg,username='pocket watch',channel='#boring-tests',slack_group=other['slack_group'])
+            routing_index = compile_routing_index(get_notification_routes())
+            destination_messages = build_destination_messages(route_stale_packages(newly_stale, routing_index, wprdc_datasets))
+            send_destination_messages(destination_messages)
         else:
             print("[Slack alerts are muted.]")
 
 
     store_as_json(currently_stale)
+    store_due_index(due_entries)
+
+default_shard_dir = 'shards' # Relative to the script's directory; this should be shared by all the workers.
+shard_max_age = timedelta(hours=6) # Older shards are assumed to be left over from a previous run.
+
+def get_shard_dir(shard_dir):
+    """Resolve a relative shard directory against the script's directory (an
+    absolute one, like a shared mount, is used as is)."""
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), shard_dir)
+
+def store_glance_shard(stale_packages, due_entries, package_count, packages_with_frequencies, shard_dir, shard, run_id=None):
+    shard_records = {}
+    for package_id, record in stale_packages.items():
+        shard_records[package_id] = dict(record, last_modified=record['last_modified'].isoformat())
+    output = {'generated_at': datetime.now(local_timezone).isoformat(),
+        'run_id': run_id,
+        'package_count': package_count,
+        'packages_with_frequencies': packages_with_frequencies,
+        'stale_packages': shard_records,
+        'due_entries': due_entries}
+    store_shard(output, get_shard_dir(shard_dir), 'glance', shard)
+    print("Stored {} stale packages for shard {} of {}.".format(len(stale_packages), *shard))
+
+def merge(shard_count, mute_alerts=True, shard_dir=default_shard_dir, run_id=None):
+    """Combine the partial results of all the shards into the same report,
+    last-scan state, and notifications that an unsharded run would produce."""
+    shards = load_shards(get_shard_dir(shard_dir), 'glance', shard_count, run_id, shard_max_age)
+    stale_packages = {}
+    due_entries = []
+    packages_with_frequencies = 0
+    for k, shard_output in enumerate(shards):
+        print("Shard {} of {} was generated at {}.".format(k, shard_count, shard_output['generated_at']))
+        for package_id, record in shard_output['stale_packages'].items():
+            record['last_modified'] = datetime.fromisoformat(record['last_modified'])
+            stale_packages[package_id] = record
+        due_entries += shard_output['due_entries']
+        packages_with_frequencies += shard_output['packages_with_frequencies']
+    package_count = shards[0]['package_count']
+    report_staleness(stale_packages, due_entries, package_count, packages_with_frequencies, mute_alerts)
+
+def main(mute_alerts=True, check_private_datasets=False, skip_watchdog=False, test_mode=False, shard=None, shard_dir=default_shard_dir, run_id=None):
+    if not skip_watchdog:
+        watchdog.main(just_testing=False, shard=shard)
+    if False: # [ ] The code in this branch can be eliminated.
+        host = "data.wprdc.org"
+        url = "https://{}/api/3/action/current_package_list_with_resources?limit=999999".format(host)
+        r = requests.get(url)
+        response = r.json()
+        if not response['success']:
+            msg = "Unable to get the package list."
+            print(msg)
+            raise ValueError(msg)
+
+        packages = response['result']
+    else:
+        from credentials import site, ckan_api_key as API_key
+        if not check_private_datasets:
+            API_key = None
+        packages = fetch_packages(site, API_key) # Without an API key, only public packages are returned.
+
+    extensions = dict(hardcoded_extensions)
+    probes = load_from_json(watchdog.probe_file, {}) # Table metrics from the last watchdog run
+    resource_index = build_resource_index(packages)
+    coverage_summary = load_coverage_summary(site, API_key)
+
+    packages_with_frequencies = 0
+    stale_packages = {}
+    due_entries = []
+    for i,package in enumerate(packages):
+        if 'frequency_publishing' in package.keys() and in_shard(package['id'], shard):
+            record, due_entry = evaluate_package(i, package, extensions, probes, resource_index, coverage_summary)
+            if record is not None:
+                due_entries.append(due_entry)
+                if record['stale']:
+                    stale_packages[package['id']] = record
+            packages_with_frequencies += 1
+
+    if shard is not None:
+        # Leave the reporting to the merge step.
+        store_glance_shard(stale_packages, due_entries, len(packages), packages_with_frequencies, shard_dir, shard, run_id)
+    else:
+        report_staleness(stale_packages, due_entries, len(packages), packages_with_frequencies, mute_alerts)
 
 from credentials import production
 try:
@@ -573,6 +902,11 @@ try:
         check_private_datasets = False
         skip_watchdog = False
         test_mode = False
+        forecast_hours = None
+        shard = None
+        merge_count = None
+        shard_dir = default_shard_dir
+        run_id = None
         args = sys.argv[1:]
         copy_of_args = list(args)
         for k,arg in enumerate(copy_of_args):
@@ -591,10 +925,35 @@ try:
             elif arg in ['skip','snooze']:
                 skip_watchdog = True
                 args.remove(arg)
+            elif arg in ['forecast']: # Usage: python glance.py forecast 48
+                forecast_hours = 24
+                args.remove(arg)
+                if k+1 < len(copy_of_args) and copy_of_args[k+1].replace('.','',1).isdigit():
+                    forecast_hours = float(copy_of_args[k+1]) if '.' in copy_of_args[k+1] else int(copy_of_args[k+1])
+                    args.remove(copy_of_args[k+1])
+            elif arg in ['shard'] and k+1 < len(copy_of_args): # Usage: python glance.py shard 2/8
+                shard = parse_shard(copy_of_args[k+1])
+                args.remove(arg)
+                args.remove(copy_of_args[k+1])
+            elif arg in ['merge'] and k+1 < len(copy_of_args): # Usage: python glance.py merge 8
+                merge_count = int(copy_of_args[k+1])
+                args.remove(arg)
+                args.remove(copy_of_args[k+1])
+            elif arg.startswith('shard_dir='):
+                shard_dir = arg.split('=', 1)[1]
+                args.remove(arg)
+            elif arg.startswith('run_id='): # Usage: python glance.py shard 2/8 run_id=2026-10-19
+                run_id = arg.split('=', 1)[1]
+                args.remove(arg)
         if len(args) > 0:
             print("Unused command-line arguments: {}".format(args))
 
-        main(mute_alerts,check_private_datasets,skip_watchdog,test_mode)
+        if forecast_hours is not None:
+            forecast(forecast_hours)
+        elif merge_count is not None:
+            merge(merge_count,mute_alerts,shard_dir,run_id)
+        else:
+            main(mute_alerts,check_private_datasets,skip_watchdog,test_mode,shard,shard_dir,run_id)
 
 except:
     e = sys.exc_info()[0]
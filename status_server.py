@@ -0,0 +1,191 @@
+# This script serves glance's staleness evaluations over HTTP, so that
+# dashboards and other bots can get the current list of stale datasets
+# without running glance.py or parsing its output.
+
+# The evaluated package records are kept in memory and refreshed in a
+# background thread. Each refresh only fetches the packages modified since
+# the last one (with package_search) and then re-evaluates all packages
+# (since lateness depends on the current time, but that doesn't require
+# any more requests to CKAN). Every so often, the whole catalog is reloaded
+# to catch deleted packages, along with the coverage summary. Watchdog's
+# probes are only reread when probes.json changes.
+
+# Usage:
+#       > python status_server.py [port] [private]
+# Endpoints (all return JSON):
+#       /stale              The stale packages
+#       /packages           All packages with publishing periods
+#       /packages/<id>      A single package
+# /stale and /packages can be filtered with the query parameters publisher,
+# upload_method and min_cycles_late, like
+#       /stale?publisher=Allegheny%20County&min_cycles_late=2
+
+import os, sys, json, time, threading, traceback
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import glance, watchdog
+from watchdog_util.catalog import fetch_packages
+
+refresh_interval = timedelta(minutes=5)
+full_reload_interval = timedelta(hours=1)
+
+class StatusIndex():
+    """The in-memory index of evaluated package records."""
+    def __init__(self, API_key=None):
+        self.API_key = API_key
+        self.lock = threading.Lock()
+        self.packages = {}
+        self.records = {}
+        self.by_publisher = {}
+        self.by_upload_method = {}
+        self.last_modified = None # The most recent metadata_modified value seen
+        self.last_full_reload = None
+        self.refreshed_at = None
+        self.coverage_summary = {}
+        self.probes = {}
+        self.probes_mtime = None
+
+    def fetch_modified_packages(self):
+        """Get the packages modified since the last refresh (or all of them, if
+        it's time for a full reload)."""
+        from credentials import site
+        if self.last_modified is None or datetime.now() - self.last_full_reload > full_reload_interval:
+            self.last_full_reload = datetime.now()
+            return fetch_packages(site, self.API_key), True
+        return fetch_packages(site, self.API_key, fq='metadata_modified:[{}Z TO *]'.format(self.last_modified)), False
+
+    def load_probes(self):
+        """Returns watchdog's probes, rereading probes.json only if it has
+        changed since it was last read."""
+        probe_path = watchdog.get_state_path(watchdog.probe_file)
+        mtime = os.path.getmtime(probe_path) if os.path.exists(probe_path) else None
+        if mtime != self.probes_mtime:
+            self.probes = watchdog.load_state(watchdog.probe_file)
+            self.probes_mtime = mtime
+        return self.probes
+
+    def refresh(self):
+        modified_packages, full_reload = self.fetch_modified_packages()
+        packages = {} if full_reload else dict(self.packages)
+        for package in modified_packages:
+            packages[package['id']] = package
+
+        probes = self.load_probes()
+        resource_index = glance.build_resource_index(packages.values())
+        if full_reload:
+            from credentials import site
+            self.coverage_summary = glance.load_coverage_summary(site, self.API_key)
+        records = {}
+        for i, package in enumerate(packages.values()):
+            if 'frequency_publishing' in package.keys():
+                try:
+                    record, _ = glance.evaluate_package(i, package, glance.hardcoded_extensions, probes, resource_index, self.coverage_summary)
+                except Exception as e: # One malformed package shouldn't take down the whole index.
+                    print("Unable to evaluate {} ({}): {}: {}".format(package.get('title'), package.get('id'), type(e).__name__, e))
+                    continue
+                if record is not None:
+                    records[package['id']] = record
+
+        by_publisher, by_upload_method = {}, {}
+        for package_id, record in records.items():
+            by_publisher.setdefault(record['publisher'], []).append(package_id)
+            by_upload_method.setdefault(record['upload_method'], []).append(package_id)
+
+        with self.lock:
+            self.packages = packages
+            self.records = records
+            self.by_publisher = by_publisher
+            self.by_upload_method = by_upload_method
+            if len(packages) > 0:
+                self.last_modified = max(p['metadata_modified'] for p in packages.values())
+            self.refreshed_at = datetime.now()
+
+    def query(self, stale_only=False, publisher=None, upload_method=None, min_cycles_late=None):
+        with self.lock:
+            package_ids = self.records.keys()
+            if publisher is not None:
+                package_ids = self.by_publisher.get(publisher, [])
+            if upload_method is not None:
+                package_ids = set(package_ids) & set(self.by_upload_method.get(upload_method, []))
+            records = [self.records[package_id] for package_id in package_ids]
+        if stale_only:
+            records = [r for r in records if r['stale']]
+        if min_cycles_late is not None:
+            records = [r for r in records if max(r['cycles_late'], r.get('data_cycles_late', 0)) >= min_cycles_late]
+        return sorted(records, key=lambda r: -r['cycles_late'])
+
+    def get(self, package_id):
+        with self.lock:
+            return self.records.get(package_id)
+
+def keep_refreshing(index):
+    while True:
+        try:
+            index.refresh()
+        except Exception:
+            # Keep serving the last good records if a refresh fails.
+            print(''.join('!! ' + line for line in traceback.format_exception(*sys.exc_info())))
+        time.sleep(refresh_interval.total_seconds())
+
+def make_handler(index):
+    class StatusHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, content):
+            body = json.dumps(content, default=str).encode('utf-8') # default=str handles the datetimes.
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            parts = [part for part in url.path.split('/') if part != '']
+            if index.refreshed_at is None:
+                self.send_json(503, {'error': 'The package records have not been loaded yet.'})
+            elif parts in [['stale'], ['packages']]:
+                try:
+                    min_cycles_late = float(params['min_cycles_late']) if 'min_cycles_late' in params else None
+                except ValueError:
+                    self.send_json(400, {'error': 'min_cycles_late must be a number.'})
+                    return
+                records = index.query(parts[0] == 'stale', params.get('publisher'), params.get('upload_method'), min_cycles_late)
+                self.send_json(200, {'refreshed_at': index.refreshed_at, 'count': len(records), 'results': records})
+            elif len(parts) == 2 and parts[0] == 'packages':
+                record = index.get(parts[1])
+                if record is None:
+                    self.send_json(404, {'error': 'No package with ID {} and a publishing period was found.'.format(parts[1])})
+                else:
+                    self.send_json(200, {'refreshed_at': index.refreshed_at, 'result': record})
+            else:
+                self.send_json(404, {'error': 'Unknown endpoint. Try /stale, /packages, or /packages/<id>.'})
+
+        def log_message(self, format, *args):
+            pass # Keep the console output for refresh errors.
+    return StatusHandler
+
+def main(port=8000, check_private_datasets=False):
+    from credentials import ckan_api_key as API_key
+    if not check_private_datasets:
+        API_key = None
+    index = StatusIndex(API_key)
+    refresher = threading.Thread(target=keep_refreshing, args=(index,), daemon=True)
+    refresher.start()
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(index))
+    print("Serving package staleness on http://127.0.0.1:{}/stale".format(port))
+    server.serve_forever()
+
+if __name__ == '__main__':
+    port = 8000
+    check_private_datasets = False
+    for arg in sys.argv[1:]:
+        if arg.isdigit():
+            port = int(arg)
+        elif arg in ['private']:
+            check_private_datasets = True
+        else:
+            print("Unused command-line argument: {}".format(arg))
+    main(port, check_private_datasets)
@@ -1,16 +1,52 @@
-from datetime import datetime
-import ckanapi, json, sys
+from datetime import datetime, timedelta
+import ckanapi, json, os, sys, threading
+from concurrent.futures import ThreadPoolExecutor
 from dateutil import parser
+from dateutil.relativedelta import relativedelta
 
 import traceback
 from notify import send_to_slack
 from watchdog_util.leash import fill_bowl, empty_bowl, initially_leashed
+from watchdog_util.catalog import fetch_packages
+from watchdog_util.schedule import publishing_periods, local_timezone
+from watchdog_util.shards import parse_shard, in_shard
+from watchdog_util.governor import QueryGovernor
+from watchdog_util.output import buffered_stdout
 
 try:
     from icecream import ic
 except ImportError:  # Graceful fallback if IceCream isn't installed.
     ic = lambda *a: None if not a else (a[0] if len(a) == 1 else a) # noqa
 
+def get_state_path(filename):
+    # Keep watchdog's state files next to the script so that cron jobs find them.
+    dname = os.path.dirname(os.path.abspath(__file__))
+    return dname+'/'+filename
+
+state_lock = threading.RLock() # Packages are watched in parallel threads, which share the state files.
+
+def store_state(output,filename):
+    with state_lock:
+        with open(get_state_path(filename) + '.tmp', 'w') as f:
+            json.dump(output, f, ensure_ascii=True, indent = 4)
+        os.replace(get_state_path(filename) + '.tmp', get_state_path(filename))
+
+def load_state(filename,default=None):
+    state_file = get_state_path(filename)
+    with state_lock:
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                return json.load(f)
+    return {} if default is None else default
+
+def update_state(filename,key,value):
+    """Set one entry of a state file's dict (without losing entries written by
+    other threads in the meantime)."""
+    with state_lock:
+        state = load_state(filename)
+        state[key] = value
+        store_state(state,filename)
+
 def get_metadata(site,resource_id,API_key=None):
     metadata = ckan.action.resource_show(id=resource_id)
 
@@ -185,21 +221,254 @@ def random_string(stringLength=10):
     letters = string.ascii_lowercase
     return ''.join(random.choice(letters) for i in range(stringLength))
 
-def find_extremes(resource_id,field):
+table_cost_file = 'table_costs.json'
+# Errors in a query itself (like bad SQL or a missing table) say nothing about
+# how the datastore is coping, so they don't slow the other queries down.
+benign_query_errors = (ckanapi.errors.ValidationError, ckanapi.errors.NotFound, ckanapi.errors.NotAuthorized)
+default_query_governor = QueryGovernor(ceiling=1, benign_exceptions=benign_query_errors) # For queries made outside of main(), which passes down its own.
+
+def query_cost_key(resource_id,kind='probe'):
+    """Query costs are tracked separately for each kind of query on a table
+    (like 'probe' or 'gaps'), since their running times can differ a lot."""
+    return '{}:{}'.format(resource_id,kind)
+
+def query_leashed_resource(resource_id,query,kind='probe',governor=None):
     from credentials import site, ckan_api_key as API_key
 
     toggle = initially_leashed(resource_id)
     if toggle:
         fill_bowl(resource_id)
-    biggest_name = 'biggest_' + random_string(5) # Append a random string to avoid query caching.
-    query = 'SELECT min("{}") AS smallest, max("{}") as {} FROM "{}" LIMIT 1'.format(field,field,biggest_name,resource_id)
-    #query = 'SELECT min("{}") AS smallest, max("{}") as biggest FROM "{}" LIMIT 1'.format(field,field,resource_id)
-    record = query_resource(site=site, query=query, API_key=API_key)[0]
+    if governor is None:
+        governor = default_query_governor
+    with governor.query(query_cost_key(resource_id,kind)):
+        records = query_resource(site=site, query=query, API_key=API_key)
     if toggle: # Strictly speaking this may not be necessary, as bowl-emptying may have no effect on some resources.
         empty_bowl(resource_id)
-    return record['smallest'], record[biggest_name] #record['biggest']
+    return records
+
+schema_cache_file = 'schema_cache.json'
+temporal_types = ['timestamp', 'timestamptz', 'date']
+text_types = ['text', 'varchar'] # These may hold timestamps that need to be cast.
+
+def resource_fingerprint(resource):
+    """Returns a string that changes whenever the resource (and therefore possibly
+    its datastore schema) changes."""
+    return '|'.join(str(resource.get(key)) for key in ['last_modified', 'metadata_modified', 'revision_id', 'hash'])
+
+def get_datastore_fields(resource,API_key=None):
+    """Returns a dict mapping the resource's datastore field names to their types.
+    The fields are fetched with a zero-row datastore_search and cached in
+    schema_cache.json until the resource's fingerprint changes."""
+    from credentials import site
+
+    cache = load_state(schema_cache_file)
+    fingerprint = resource_fingerprint(resource)
+    cached = cache.get(resource['id'])
+    if cached is not None and cached['fingerprint'] == fingerprint:
+        return cached['fields']
+    ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
+    response = ckan.action.datastore_search(id=resource['id'], limit=0)
+    fields = {f['id']: f['type'] for f in response['fields']}
+    update_state(schema_cache_file,resource['id'],{'fingerprint': fingerprint, 'fields': fields})
+    return fields
+
+def check_time_field(fields,time_field):
+    """Returns a description of the problem with using time_field as the time
+    field of a table with the given fields (or None if there is no problem)."""
+    if time_field not in fields:
+        return "time_field {} is not one of the datastore fields ({})".format(time_field, ', '.join(fields))
+    if fields[time_field] not in temporal_types + text_types:
+        return "time_field {} has type {}, which can not hold dates".format(time_field, fields[time_field])
+    return None
+
+# SQL for each metric that probe_table() can compute. {field} is the quoted time
+# field, {timestamp} is the time field cast to a timestamp (if necessary),
+# {smallest_sql} and {biggest_sql} are the extremes of the time field (see
+# extreme_sql()),
+# {biggest} is a randomized column name (to avoid query caching), and
+# {seconds} is the length of the publishing period.
+probe_metrics = {'extremes': '{smallest_sql} AS smallest, {biggest_sql} AS {biggest}',
+        'row_count': 'count(*) AS row_count',
+        'recent_rows': 'count(*) FILTER (WHERE {timestamp} >= now() - interval \'{seconds} seconds\') AS recent_rows',
+        'max_id': 'max("_id") AS max_id'}
+# 'recent_rows' scans the whole table and nothing reads it yet, so it's only
+# computed for packages that ask for it (with a probe_metrics extras field).
+default_probe_metrics = ['extremes', 'row_count', 'max_id']
+
+probe_file = 'probes.json'
+
+def as_timestamp_sql(field,field_type=None):
+    """Returns SQL for the quoted field, cast to a timestamp unless the datastore
+    type is already temporal. Text values that don't start with a date (like
+    empty strings) become NULL rather than making the whole query fail."""
+    if field_type in temporal_types:
+        return '"{}"'.format(field)
+    return '(CASE WHEN "{0}" ~ \'^[0-9]{{4}}-[0-9]{{2}}-[0-9]{{2}}\' THEN "{0}"::timestamp END)'.format(field)
+
+def extreme_sql(function,field,field_type=None):
+    """Returns SQL for the min or max of the field. For temporal fields, the
+    extreme is formatted on the server as an ISO 8601 string (converted to UTC,
+    for fields with time zones), so that it can be parsed with the fast
+    datetime.fromisoformat() (see parse_extreme())."""
+    extreme = '{}("{}")'.format(function,field)
+    if field_type == 'timestamptz':
+        return 'to_char({} AT TIME ZONE \'UTC\', \'YYYY-MM-DD"T"HH24:MI:SS.US"+00:00"\')'.format(extreme)
+    if field_type == 'timestamp':
+        return 'to_char({}, \'YYYY-MM-DD"T"HH24:MI:SS.US\')'.format(extreme)
+    if field_type == 'date':
+        return 'to_char({}, \'YYYY-MM-DD\')'.format(extreme)
+    return extreme
+
+def probe_table(resource_id,field,metrics=None,publishing_period=None,field_type=None,governor=None):
+    """Compute the requested metrics (by default, those in default_probe_metrics)
+    for a table in a single datastore_search_sql query. The 'recent_rows' metric
+    (the number of rows with time-field values in the last publishing period)
+    is skipped if no publishing_period (a timedelta) is given."""
+    if metrics is None:
+        metrics = default_probe_metrics
+    if publishing_period is None:
+        metrics = [m for m in metrics if m != 'recent_rows']
+    biggest_name = 'biggest_' + random_string(5) # Append a random string to avoid query caching.
+    seconds = int(publishing_period.total_seconds()) if publishing_period is not None else None
+    columns = [probe_metrics[m].format(field='"{}"'.format(field), timestamp=as_timestamp_sql(field,field_type),
+        smallest_sql=extreme_sql('min',field,field_type), biggest_sql=extreme_sql('max',field,field_type),
+        biggest=biggest_name, seconds=seconds) for m in metrics]
+    query = 'SELECT {} FROM "{}" LIMIT 1'.format(', '.join(columns),resource_id)
+    record = query_leashed_resource(resource_id,query,governor=governor)[0]
+    if biggest_name in record:
+        record['biggest'] = record.pop(biggest_name)
+    return record
+
+def find_extremes(resource_id,field):
+    record = probe_table(resource_id,field,['extremes'])
+    return record['smallest'], record['biggest']
+
+parse_strategies = {} # Maps resource IDs to the parsers that have worked on their values.
+
+def parse_extreme(resource_id,value):
+    """Parse an extreme value of a time field into a timezone-aware datetime.
+
+    ISO 8601 values (which is what the server returns for temporal fields)
+    are parsed with the fast datetime.fromisoformat(). Resources whose values
+    turn out to need the much slower (but more flexible) dateutil parser are
+    remembered, so that fromisoformat() isn't attempted on them again. Values
+    without time zones are taken to be in local time."""
+    if parse_strategies.get(resource_id) == 'dateutil':
+        dt = parser.parse(value)
+    else:
+        try:
+            dt = datetime.fromisoformat(value)
+            parse_strategies[resource_id] = 'isoformat'
+        except ValueError:
+            dt = parser.parse(value)
+            parse_strategies[resource_id] = 'dateutil'
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=local_timezone)
+    return dt
+
+def rows_changed_at(probe,previous_probe=None):
+    """Returns when the table's rows were last seen to change, judging by its
+    row_count and max_id metrics (the time of this probe, unless they match the
+    previous probe's), or None if neither metric was probed."""
+    if probe.get('row_count') is None and probe.get('max_id') is None:
+        return None
+    if previous_probe is not None and previous_probe.get('rows_changed_at') is not None:
+        if all(previous_probe.get(m) == probe.get(m) for m in ['row_count', 'max_id']):
+            return previous_probe['rows_changed_at']
+    return probe['probed_at']
+
+def store_probes(package_id,probes):
+    """Save the probe results for a package's tables, so that glance can use them
+    in deciding whether the package is stale."""
+    update_state(probe_file,package_id,probes)
+
+gap_cache_file = 'gap_cache.json'
+bucket_steps = {'day': relativedelta(days=1),
+        'week': relativedelta(weeks=1),
+        'month': relativedelta(months=1)}
+
+def count_by_bucket(resource_id,field,bucket='week',since=None,field_type=None,governor=None):
+    """Count the rows and the distinct days in each [bucket] of the time field
+    with a single server-side aggregate query, optionally only for buckets
+    starting at or after [since]."""
+    field_sql = as_timestamp_sql(field,field_type)
+    where = " WHERE {} >= '{}'".format(field_sql,since) if since is not None else ""
+    rows_name = 'row_count_' + random_string(5) # Append a random string to avoid query caching.
+    query = 'SELECT date_trunc(\'{}\', {}) AS bucket, count(DISTINCT date_trunc(\'day\', {})) AS days, count(*) AS {} FROM "{}"{} GROUP BY 1 ORDER BY 1'.format(bucket,field_sql,field_sql,rows_name,resource_id,where)
+    records = query_leashed_resource(resource_id,query,'gaps',governor)
+    return {r['bucket']: [r['days'], r[rows_name]] for r in records if r['bucket'] is not None}
+
+def table_snapshot(probe,field_type=None):
+    """The parts of a table's probe that reveal reloads and backfills."""
+    return {'field_type': field_type, 'row_count': probe.get('row_count'), 'max_id': probe.get('max_id'), 'smallest': probe.get('smallest')}
 
-def fix_temporal_coverage(package_id,time_field_lookup,test=False):
+def looks_reloaded(resource_id,old,new):
+    """Returns True if the table seems to have been reloaded or backfilled between
+    two snapshots (from table_snapshot()): its time field changed type, it lost
+    rows or _id values, or its earliest time-field value moved earlier."""
+    if old.get('field_type') != new['field_type']:
+        return True
+    for metric in ['row_count', 'max_id']:
+        if old.get(metric) is not None and new[metric] is not None and new[metric] < old[metric]:
+            return True
+    if old.get('smallest') is not None and new['smallest'] is not None:
+        return parse_extreme(resource_id,new['smallest']) < parse_extreme(resource_id,old['smallest'])
+    return False
+
+def find_gaps(resource_id,field,bucket='week',thin_fraction=0.25,field_type=None,probe=None,governor=None):
+    """Find missing and suspiciously thin periods in the time field of a table.
+
+    Per-bucket counts are cached in gap_cache.json, so only the most recent
+    cached bucket (which may have been incomplete) and any newer buckets are
+    recounted on later runs. If the table's current probe is given, the cached
+    counts are thrown out when it looks like the table has been reloaded or
+    backfilled since they were made (see looks_reloaded()).
+
+    A bucket is considered thin if it has fewer than thin_fraction times the
+    median number of rows or of distinct days per bucket. The first and last
+    buckets are never reported as thin, since the data probably starts partway
+    through the first one and the last one is probably still being filled."""
+    cache = load_state(gap_cache_file)
+    cached = cache.get(resource_id, {})
+    snapshot = table_snapshot(probe,field_type) if probe is not None else None
+    if cached.get('field') != field or cached.get('bucket') != bucket or \
+            (snapshot is not None and looks_reloaded(resource_id,cached.get('snapshot') or {},snapshot)):
+        cached = {'field': field, 'bucket': bucket, 'counts': {}}
+    if snapshot is not None:
+        cached['snapshot'] = snapshot
+    counts = cached['counts']
+    since = max(counts) if len(counts) > 0 else None
+    counts.update(count_by_bucket(resource_id,field,bucket,since,field_type,governor))
+    update_state(gap_cache_file,resource_id,cached)
+
+    gaps = []
+    if len(counts) == 0:
+        return gaps
+    day_counts = sorted(c[0] for c in counts.values())
+    row_counts = sorted(c[1] for c in counts.values())
+    median_days = day_counts[len(day_counts)//2]
+    median_rows = row_counts[len(row_counts)//2]
+    parsed = {parser.parse(b): c for b,c in counts.items()}
+    first, last = min(parsed), max(parsed)
+    current = first + bucket_steps[bucket]
+    while current < last:
+        if current not in parsed:
+            gaps.append({'bucket': current.isoformat(), 'days': 0, 'rows': 0, 'problem': 'missing'})
+        elif parsed[current][0] < thin_fraction*median_days or parsed[current][1] < thin_fraction*median_rows:
+            days, rows = parsed[current]
+            gaps.append({'bucket': current.isoformat(), 'days': days, 'rows': rows, 'problem': 'thin'})
+        current += bucket_steps[bucket]
+    return gaps
+
+def print_gap_report(resource_name,time_field,gaps,bucket='week'):
+    if len(gaps) == 0:
+        print("  No gaps found in {} of {}.".format(time_field,resource_name))
+        return
+    print("  Found {} suspicious {}s in {} of {}:".format(len(gaps),bucket,time_field,resource_name))
+    for gap in gaps:
+        print("    {} starting {} ({} rows over {} distinct days)".format(gap['problem'],gap['bucket'],gap['rows'],gap['days']))
+
+def fix_temporal_coverage(package_id,time_field_lookup,test=False,detect_gaps=False,metrics=None,publishing_period=None,governor=None):
     from credentials import site, ckan_api_key as API_key
 
     parameter = "temporal_coverage"
@@ -207,20 +476,39 @@ def fix_temporal_coverage(package_id,time_field_lookup,test=False):
     title = get_package_parameter(site,package_id,parameter="title",API_key=API_key)
     print("Initial temporal coverage of {} = {}".format(title,initial_value))
     # Find all resources in package that have datastores.
-    best_first = datetime(3000,4,13)
-    best_last = datetime(1000,5,14)
+    best_first = datetime(3000,4,13,tzinfo=local_timezone)
+    best_last = datetime(1000,5,14,tzinfo=local_timezone)
     resources = get_package_parameter(site,package_id,'resources',API_key)
     temporal_coverage_join_operator = get_temporal_coverage_join_operator(site,package_id,API_key)
+    if metrics is not None and 'extremes' not in metrics:
+        metrics = ['extremes'] + metrics # The extremes are needed for the temporal coverage.
+    previous_probes = load_state(probe_file).get(package_id, {})
+    probes = {}
+    skipped = []
     for r in resources:
         if r['datastore_active']:
             resource_id = r['id']
             if resource_id in time_field_lookup:
                 time_field = time_field_lookup[resource_id]
-                first, last = find_extremes(resource_id,time_field)
+                fields = get_datastore_fields(r,API_key)
+                problem = check_time_field(fields,time_field)
+                if problem is not None:
+                    print("  Skipping {} ({}) because its {}.".format(r['name'],resource_id,problem))
+                    skipped.append({'package_id': package_id, 'resource_id': resource_id, 'name': r['name'], 'problem': problem})
+                    continue
+                field_type = fields[time_field]
+                probe = probe_table(resource_id,time_field,metrics,publishing_period,field_type,governor)
+                probe['time_field'] = time_field
+                probe['probed_at'] = datetime.now(local_timezone).isoformat()
+                probe['rows_changed_at'] = rows_changed_at(probe,previous_probes.get(resource_id))
+                probes[resource_id] = probe
+                first, last = probe['smallest'], probe['biggest']
                 if first is None or last is None:
                     raise RuntimeError("No values found for time_field = {} in {}. Probably the table is empty.".format(time_field, r['name']))
-                first = parser.parse(first)
-                last = parser.parse(last)
+                first = parse_extreme(resource_id,first)
+                last = parse_extreme(resource_id,last)
+                if detect_gaps:
+                    print_gap_report(r['name'],time_field,find_gaps(resource_id,time_field,field_type=field_type,probe=probe,governor=governor))
                 if temporal_coverage_join_operator == 'union':
                     if first < best_first: # Here best_first == very_first
                         best_first = first
@@ -234,10 +522,16 @@ def fix_temporal_coverage(package_id,time_field_lookup,test=False):
                 else:
                     raise RuntimeError("No specification for temporal_coverage_join_operator = {}.".format(temporal_coverage_join_operator))
 
+    store_probes(package_id,probes)
+
+    if len(probes) == 0:
+        print("  No update made because none of the monitored tables could be probed.")
+        return skipped
+
     if best_first > best_last: # The temporal coverage join operator needs to be changed.
         raise ValueError("Disjoint temporal coverages detected for package_id = {}.".format(package_id))
 
-    temporal_coverage = "{}/{}".format(best_first.date(),best_last.date())
+    temporal_coverage = "{}/{}".format(best_first.astimezone(local_timezone).date(),best_last.astimezone(local_timezone).date())
     print("  New temporal coverage for {} ({}) = {}".format(title,package_id,temporal_coverage))
     # Alter metadata for package
     if initial_value != temporal_coverage:
@@ -247,20 +541,138 @@ def fix_temporal_coverage(package_id,time_field_lookup,test=False):
             print("  No update made because this is just a test.")
     else:
         print("  No update needed. (Existing temporal coverage matches current temporal coverage.)")
+    return skipped
+
+def watch_package(package,just_testing,detect_gaps=False,governor=None):
+    """Update the temporal coverage of the package if it has any monitored tables,
+    returning the list of tables that had to be skipped."""
+    if not package['private']: # Ignore private packages
+        if 'extras' in package:
+            extras_list = package['extras']
+            # Keep definitions and uses of extras metadata updated here:
+            # https://github.com/WPRDC/data-guide/blob/master/docs/metadata_extras.md
+            # The format is like this:
+            #       u'extras': [{u'key': u'dcat_issued', u'value': u'2014-01-07T15:27:45.000Z'}, ...
+            # not a dict, but a list of dicts.
+            extras = {d['key']: d['value'] for d in extras_list}
+            #if 'dcat_issued' not in extras:
+            if 'time_field' in extras:
+                time_field_lookup = json.loads(extras['time_field'])
+                # The set of probe metrics can be overridden with a JSON list, like
+                #       u'extras': [{u'key': u'probe_metrics', u'value': u'["extremes", "row_count"]'}]
+                metrics = json.loads(extras['probe_metrics']) if 'probe_metrics' in extras else None
+                publishing_period = publishing_periods.get(package.get('frequency_publishing'))
+                return fix_temporal_coverage(package['id'],time_field_lookup,just_testing,detect_gaps,metrics,publishing_period,governor)
+    return []
+
+checkpoint_file = 'watchdog_checkpoint.json'
+checkpoint_max_age = timedelta(hours=12) # Older checkpoints are from abandoned runs and are ignored.
+
+def new_checkpoint(just_testing,shard=None):
+    return {'started_at': datetime.now().isoformat(), 'just_testing': just_testing, 'shard': shard, 'completed': [], 'errors': [], 'skipped': []}
+
+def load_checkpoint(just_testing,shard=None):
+    """Returns the checkpoint of an interrupted run (in the same mode and shard) if
+    there is a recent enough one, or else a fresh checkpoint."""
+    checkpoint = load_state(checkpoint_file)
+    if 'started_at' in checkpoint and checkpoint.get('just_testing') == just_testing and checkpoint.get('shard') == (list(shard) if shard is not None else None):
+        if datetime.now() - parser.parse(checkpoint['started_at']) < checkpoint_max_age:
+            return checkpoint
+    return new_checkpoint(just_testing,shard)
+
+def print_run_report(report):
+    if len(report['skipped']) > 0:
+        print("\nSkipped {} monitored tables with unusable time fields:".format(len(report['skipped'])))
+        for s in report['skipped']:
+            print("  {} ({}) in package {}: {}".format(s['name'],s['resource_id'],s['package_id'],s['problem']))
+    if len(report['errors']) > 0:
+        print("\nFailed to update the temporal coverage of {} packages:".format(len(report['errors'])))
+        for e in report['errors']:
+            print("  {} ({}): {}".format(e['title'],e['package_id'],e['error']))
+
+# The coverage summary is a datastore table with one row per monitored table,
+# so that the temporal coverage of the whole portal can be read with a single
+# datastore_search. Its resource ID is set by coverage_summary_resource_id in
+# credentials.py (if it's not set, no summary is published).
+coverage_summary_fields = [{'id': 'resource_id', 'type': 'text'},
+        {'id': 'package_id', 'type': 'text'},
+        {'id': 'time_field', 'type': 'text'},
+        {'id': 'min', 'type': 'timestamptz'},
+        {'id': 'max', 'type': 'timestamptz'},
+        {'id': 'row_count', 'type': 'int8'},
+        {'id': 'probed_at', 'type': 'timestamptz'}]
+
+def coverage_summary_records(all_probes):
+    records = []
+    for package_id, probes in all_probes.items():
+        for resource_id, probe in probes.items():
+            if probe.get('smallest') is None or probe.get('biggest') is None:
+                continue
+            records.append({'resource_id': resource_id,
+                'package_id': package_id,
+                'time_field': probe['time_field'],
+                'min': parse_extreme(resource_id,probe['smallest']).isoformat(),
+                'max': parse_extreme(resource_id,probe['biggest']).isoformat(),
+                'row_count': probe.get('row_count'),
+                'probed_at': probe['probed_at']})
+    return records
+
+def published_coverage_rows(ckan,resource_id):
+    """Returns the resource and package IDs of every row in the coverage summary."""
+    rows = []
+    while True:
+        response = ckan.action.datastore_search(id=resource_id, fields=['resource_id', 'package_id'], limit=32000, offset=len(rows))
+        rows += response['records']
+        if len(response['records']) == 0 or len(rows) >= response['total']:
+            return rows
 
-def main(just_testing):
+def publish_coverage_summary(all_probes,shard=None,chunk_size=1000):
+    """Upsert the latest probe results for all monitored tables into the
+    coverage summary table, in a few bulk datastore_upsert calls.
+
+    all_probes should hold the probes of every currently monitored table of
+    the packages in the shard, since the summary rows of any other tables of
+    those packages (like deleted resources, tables dropped from time_field or
+    skipped because their time fields are invalid) are then deleted, so that
+    they can't keep pinning the packages' coverage."""
+    from credentials import site, ckan_api_key as API_key
+    try:
+        from credentials import coverage_summary_resource_id
+    except ImportError:
+        return
+
+    records = coverage_summary_records(all_probes)
+    ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
+    # This creates the table on the first run and is harmless afterward.
+    ckan.action.datastore_create(resource_id=coverage_summary_resource_id, fields=coverage_summary_fields, primary_key=['resource_id'], force=True)
+    for start in range(0, len(records), chunk_size):
+        ckan.action.datastore_upsert(resource_id=coverage_summary_resource_id, records=records[start:start+chunk_size], method='upsert', force=True)
+    print("Published the coverage of {} tables to the coverage summary ({}).".format(len(records),coverage_summary_resource_id))
+
+    published = set(record['resource_id'] for record in records)
+    orphans = [row['resource_id'] for row in published_coverage_rows(ckan,coverage_summary_resource_id)
+        if in_shard(row['package_id'],shard) and row['resource_id'] not in published]
+    for start in range(0, len(orphans), chunk_size):
+        ckan.action.datastore_delete(resource_id=coverage_summary_resource_id, filters={'resource_id': orphans[start:start+chunk_size]}, force=True)
+    if len(orphans) > 0:
+        print("Deleted {} tables that are no longer monitored from the coverage summary.".format(len(orphans)))
+
+def monitored_tables(package):
+    """Returns the IDs of the package's resources that have time fields."""
+    extras = {d['key']: d['value'] for d in package.get('extras', [])}
+    if 'time_field' in extras:
+        return list(json.loads(extras['time_field']).keys())
+    return []
+
+def main(just_testing,detect_gaps=False,resume=True,shard=None,max_queries=4):
     # [ ] Maybe change very_last to an empty string if it is reasonably close to the present.
     from credentials import site, ckan_api_key as API_key
 
     # Get all packages and resources
-    ckan = ckanapi.RemoteCKAN(site,apikey=API_key) # Without specifying
-    # the apikey field value, the next line will only return non-private packages.
-    # So since the API key is given here, watchdog will also watch over and update
-    # the temporal_coverage field for private datasets.
-    try:
-        packages = ckan.action.current_package_list_with_resources(limit=999999)
-    except:
-        packages = ckan.action.current_package_list_with_resources(limit=999999)
+    # Without specifying the API key, the next line will only return non-private
+    # packages. So since the API key is given here, watchdog will also watch over
+    # and update the temporal_coverage field for private datasets.
+    packages = fetch_packages(site, API_key)
 
     # For packages where all tabular data has the same schema, the time_field metadata
     # field could be specified in the package-level metadata, like this:
@@ -278,31 +690,93 @@ def main(just_testing):
     # not be clear which is the best one to use as the standard time field. The default
     # should probably be the one that is most representative of the datetime of the event
     # represented by that row.
-    for package in packages:
-        if not package['private']: # Ignore private packages
-            if 'extras' in package:
-                extras_list = package['extras']
-                # Keep definitions and uses of extras metadata updated here:
-                # https://github.com/WPRDC/data-guide/blob/master/docs/metadata_extras.md
-                # The format is like this:
-                #       u'extras': [{u'key': u'dcat_issued', u'value': u'2014-01-07T15:27:45.000Z'}, ...
-                # not a dict, but a list of dicts.
-                extras = {d['key']: d['value'] for d in extras_list}
-                #if 'dcat_issued' not in extras:
-                if 'time_field' in extras:
-                    time_field_lookup = json.loads(extras['time_field'])
-                    fix_temporal_coverage(package['id'],time_field_lookup,just_testing)
+
+    # Completed packages are recorded in a checkpoint file, so that a run that
+    # gets interrupted can be resumed without redoing all the queries.
+    report = load_checkpoint(just_testing,shard) if resume else new_checkpoint(just_testing,shard)
+    completed = set(report['completed'])
+    if len(completed) > 0:
+        print("Resuming the run started at {} ({} packages already done).".format(report['started_at'],len(completed)))
+    # Packages are watched in parallel, but the number of datastore queries in
+    # flight is limited by the query governor (which adapts the limit to how
+    # the datastore is coping, up to max_queries). The packages with the most
+    # expensive tables are started first, so that the cheaper ones can fill in
+    # around them.
+    costs = {key: cost for key, cost in load_state(table_cost_file).items() if ':' in key} # Drop costs saved before they were split by query kind.
+    query_governor = QueryGovernor(ceiling=max_queries, costs=costs, benign_exceptions=benign_query_errors)
+    pending = [p for p in packages if p['id'] not in completed and in_shard(p['id'],shard)]
+    pending.sort(key=lambda p: query_governor.estimate_cost([query_cost_key(r) for r in monitored_tables(p)]), reverse=True)
+    report_lock = threading.Lock()
+
+    def watch(package):
+        skipped, error = [], None
+        with output.buffered(): # Print each package's log in one piece, rather than interleaved with the others.
+            try:
+                skipped = watch_package(package,just_testing,detect_gaps,query_governor)
+            except Exception as e: # One bad package shouldn't stop the watchdog from checking the rest.
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+                print(''.join('!!! ' + line for line in lines))
+                error = {'package_id': package['id'], 'title': package['title'], 'error': "{}: {}".format(exc_type.__name__, e)}
+        with report_lock:
+            report['skipped'] += skipped
+            if error is not None:
+                report['errors'].append(error)
+            report['completed'].append(package['id'])
+            store_state(report,checkpoint_file)
+
+    with buffered_stdout() as output, ThreadPoolExecutor(max_workers=max_queries) as executor:
+        list(executor.map(watch, pending))
+    store_state(query_governor.costs,table_cost_file)
+
+    if not just_testing:
+        # Only the probes of tables that are still monitored are published
+        # (probes.json keeps the last probes of tables that have since been
+        # dropped from time_field).
+        all_probes = load_state(probe_file)
+        current_probes = {}
+        for package in packages:
+            if in_shard(package['id'],shard) and package['id'] in all_probes:
+                current_probes[package['id']] = {resource_id: all_probes[package['id']][resource_id]
+                    for resource_id in monitored_tables(package) if resource_id in all_probes[package['id']]}
+        try:
+            publish_coverage_summary(current_probes,shard)
+        except Exception as e:
+            report['errors'].append({'package_id': 'n/a', 'title': 'the coverage summary', 'error': "{}: {}".format(type(e).__name__, e)})
+
+    print_run_report(report)
+    # This is done here (rather than when watchdog.py is run from the command
+    # line) so that runs started by glance.py also report their errors.
+    if len(report['errors']) > 0 and not just_testing and production:
+        msg = "watchdog.py was unable to update {} packages: {}".format(len(report['errors']), ', '.join(e['title'] for e in report['errors']))
+        send_to_slack(msg,username='watchdog',channel='#watchdog',icon=':doge:')
+    if os.path.exists(get_state_path(checkpoint_file)):
+        os.remove(get_state_path(checkpoint_file)) # The run is finished, so the next one should start from the beginning.
+    return report
 
 from credentials import production
 try:
     if __name__ == '__main__':
         just_testing = False
-        if len(sys.argv) > 1:
-            if sys.argv[1] == 'True':
+        detect_gaps = False
+        resume = True
+        shard = None
+        max_queries = 4
+        args = sys.argv[1:]
+        for k,arg in enumerate(args):
+            if arg == 'True':
                 just_testing = True
-            elif sys.argv[1] == 'False':
+            elif arg == 'False':
                 just_testing = False
-        main(just_testing=just_testing)
+            elif arg in ['gaps']:
+                detect_gaps = True
+            elif arg in ['restart']: # Ignore the checkpoint of any interrupted run.
+                resume = False
+            elif arg in ['shard'] and k+1 < len(args): # Only process one shard of the packages, like "shard 2/8" (for the third of eight shards).
+                shard = parse_shard(args[k+1])
+            elif arg.startswith('max_queries='): # The ceiling on the number of datastore queries in flight
+                max_queries = int(arg.split('=', 1)[1])
+        main(just_testing=just_testing,detect_gaps=detect_gaps,resume=resume,shard=shard,max_queries=max_queries)
 except:
     e = sys.exc_info()[0]
     msg = "Error: {} : \n".format(e)
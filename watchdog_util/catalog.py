@@ -0,0 +1,61 @@
+import time, ckanapi
+from concurrent.futures import ThreadPoolExecutor
+
+# Fetching the whole catalog with one current_package_list_with_resources call
+# makes CKAN generate one huge response, and a timeout means starting over.
+# Instead, the catalog is fetched in fixed-size pages of package_search results
+# (several at a time), and only the pages that fail get retried. Packages that
+# are added or deleted during the fetch shift the pages, which can make other
+# packages show up twice or not at all, so the whole fetch is repeated if any
+# packages went missing.
+
+def fetch_page(site, API_key, start, rows, fq=None, max_attempts=3):
+    """Fetch one page of package_search results, retrying (with exponential
+    backoff) if the request fails (except for errors that would just happen
+    again, like an invalid query or a bad API key)."""
+    ckan = ckanapi.RemoteCKAN(site, apikey=API_key) # One per request, since the workers run in separate threads.
+    parameters = {'rows': rows, 'start': start, 'sort': 'id asc', # Sorting by ID keeps modified packages from moving between pages.
+            'include_private': API_key is not None}
+    if fq is not None:
+        parameters['fq'] = fq
+    for attempt in range(max_attempts):
+        try:
+            return ckan.action.package_search(**parameters)
+        except (ckanapi.errors.ValidationError, ckanapi.errors.NotAuthorized):
+            raise
+        except Exception:
+            if attempt == max_attempts - 1:
+                raise
+            print("Retrying the page of packages starting at {} after attempt {} failed.".format(start, attempt+1))
+            time.sleep(2**attempt)
+
+def fetch_packages(site, API_key=None, page_size=500, max_workers=4, fq=None, max_passes=3):
+    """Returns the list of all packages (including their resources), like
+    current_package_list_with_resources does. Private packages are included
+    if an API key is given. fq can be used to filter the packages (e.g., by
+    metadata_modified).
+
+    If fewer packages come back than package_search counted, the catalog is
+    fetched again (up to max_passes times in all). If packages are still
+    missing after that, a warning is printed and the packages from all the
+    passes are returned, so that none are silently dropped."""
+    all_packages_by_id = {}
+    for attempt in range(max_passes):
+        first_page = fetch_page(site, API_key, 0, page_size, fq)
+        starts = range(page_size, first_page['count'], page_size)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pages = list(executor.map(lambda start: fetch_page(site, API_key, start, page_size, fq)['results'], starts))
+
+        packages_by_id = {}
+        for page in [first_page['results']] + pages:
+            for package in page: # A package can show up twice if packages were added during the fetch.
+                packages_by_id[package['id']] = package
+        all_packages_by_id.update(packages_by_id)
+        if len(packages_by_id) >= first_page['count']:
+            break
+        print("Only {} of {} packages came back (probably because packages were added or deleted during the fetch).".format(len(packages_by_id), first_page['count']))
+        if attempt == max_passes - 1:
+            print("Giving up on getting a complete catalog after {} passes.".format(max_passes))
+            packages_by_id = all_packages_by_id
+    # Return the packages in the same order as current_package_list_with_resources.
+    return sorted(packages_by_id.values(), key=lambda p: p['metadata_modified'], reverse=True)
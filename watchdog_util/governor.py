@@ -0,0 +1,92 @@
+import time, threading
+from contextlib import contextmanager
+
+class QueryGovernor():
+    """Limits the number of datastore queries in flight, adjusting the limit
+    with additive increase/multiplicative decrease (AIMD): Each query that
+    finishes normally raises the limit by about one query per round of
+    queries (up to the ceiling), while a query that fails or is slow halves
+    it (down to one query at a time). As in TCP, the limit is halved at most
+    once per window: queries that were already in flight when the limit was
+    last cut don't cut it again.
+
+    A query counts as slow if it takes more than slowdown_factor times the
+    typical cost of queries on that table, so that expensive tables don't
+    look like an overloaded server. Tables with no recorded costs are
+    compared to default_latency (in seconds). Queries that fail with one of
+    the benign_exceptions (errors in the query itself, rather than signs of
+    an overloaded server) leave the limit and the costs alone.
+
+    The "tables" can be any string keys, so different kinds of queries on
+    the same table can be given separate costs.
+
+    The typical cost of each table is kept (as an exponentially weighted
+    moving average of the times of its queries that weren't slow) in the
+    costs dict, which can be saved and passed back in on the next run. Slow
+    queries only nudge the cost up by slow_cost_growth (so that a table that
+    has really grown eventually stops looking slow), which keeps a spell of
+    heavy load from becoming the new normal."""
+    def __init__(self, ceiling=4, costs=None, slowdown_factor=2.0, default_latency=10.0, benign_exceptions=(), slow_cost_growth=1.05):
+        self.ceiling = ceiling
+        self.limit = 1.0
+        self.in_flight = 0
+        self.started = 0 # The number of queries started so far
+        self.last_cut = 0 # The value of started when the limit was last halved
+        self.costs = {} if costs is None else costs
+        self.slowdown_factor = slowdown_factor
+        self.default_latency = default_latency
+        self.benign_exceptions = benign_exceptions
+        self.slow_cost_growth = slow_cost_growth
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free slot, returning the query's sequence number."""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            self.started += 1
+            return self.started
+
+    def release(self, table, latency, failed=False, counted=True, ticket=None):
+        with self.condition:
+            self.in_flight -= 1
+            if counted:
+                typical_latency = self.costs.get(table, self.default_latency)
+                slow = latency > self.slowdown_factor*typical_latency
+                if failed or slow:
+                    if ticket is None or ticket > self.last_cut:
+                        self.limit = max(1.0, self.limit/2)
+                        self.last_cut = self.started
+                else:
+                    self.limit = min(float(self.ceiling), self.limit + 1/self.limit)
+                if not failed:
+                    if table not in self.costs:
+                        self.costs[table] = latency
+                    elif slow:
+                        self.costs[table] *= self.slow_cost_growth
+                    else:
+                        self.costs[table] = 0.7*self.costs[table] + 0.3*latency
+            self.condition.notify_all()
+
+    @contextmanager
+    def query(self, table):
+        """Wait for a free slot, and time the query run in the with block."""
+        ticket = self.acquire()
+        start = time.time()
+        try:
+            yield
+        except self.benign_exceptions:
+            self.release(table, time.time() - start, counted=False)
+            raise
+        except Exception:
+            self.release(table, time.time() - start, failed=True, ticket=ticket)
+            raise
+        self.release(table, time.time() - start, ticket=ticket)
+
+    def estimate_cost(self, tables):
+        """Estimate the total query time for the given tables. Tables with no
+        recorded costs are assumed to be typical."""
+        known_costs = list(self.costs.values())
+        average_cost = sum(known_costs)/len(known_costs) if len(known_costs) > 0 else self.default_latency
+        return sum(self.costs.get(table, average_cost) for table in tables)
@@ -0,0 +1,53 @@
+import sys, threading
+from contextlib import contextmanager
+
+# When packages are watched in parallel threads, their printed output would
+# interleave line by line. While installed as sys.stdout, a
+# ThreadBufferedOutput holds on to whatever a thread prints inside a buffered()
+# block and writes it out in one piece at the end of the block. Output from
+# outside such blocks goes straight through.
+
+class ThreadBufferedOutput():
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is not None:
+            buffer.append(text)
+        else:
+            with self.lock:
+                self.stream.write(text)
+        return len(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name): # For encoding, isatty(), and so on.
+        return getattr(self.stream, name)
+
+    @contextmanager
+    def buffered(self):
+        self.local.buffer = []
+        try:
+            yield
+        finally:
+            text = ''.join(self.local.buffer)
+            self.local.buffer = None
+            with self.lock:
+                self.stream.write(text)
+                self.stream.flush()
+
+@contextmanager
+def buffered_stdout():
+    """Install a ThreadBufferedOutput as sys.stdout for the duration of the
+    with block, yielding it."""
+    output = ThreadBufferedOutput(sys.stdout)
+    sys.stdout = output
+    try:
+        yield output
+    finally:
+        sys.stdout = output.stream
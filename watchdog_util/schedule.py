@@ -0,0 +1,21 @@
+from datetime import timedelta
+from dateutil import tz
+
+# Publishing periods, keyed by the values of the 'frequency_publishing' package
+# field. These are shared by glance (for computing lateness) and watchdog (for
+# counting the rows added in the last publishing period).
+publishing_periods = {'Annually': timedelta(days = 366),
+        'Bi-Annually': timedelta(days = 183),
+        'Quarterly': timedelta(days = 31+30+31),
+        'Bi-Monthly': timedelta(days = 31+30),
+        'Monthly': timedelta(days = 31),
+        'Bi-Weekly': timedelta(days = 14),
+        'Weekly': timedelta(days = 7), # 'Weekdays' could be another period, though it seems I'm coding exceptions into the no_updates_on metadata field.
+        'Daily': timedelta(days = 1),
+        'Hourly': timedelta(hours = 1),
+        'Multiple Times per Hour': timedelta(minutes=30)}
+
+# CKAN's own timestamps (like metadata_modified) are in UTC, but dates and
+# timestamps without time zones in the data tables (and the dates in the
+# temporal_coverage field) are taken to be local to the data publishers.
+local_timezone = tz.gettz('America/New_York')
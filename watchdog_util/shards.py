@@ -0,0 +1,64 @@
+import hashlib, json, os
+from datetime import datetime, timezone
+
+# In shard mode, each worker host only processes the packages whose IDs hash
+# to its shard index and writes its partial results to a directory shared by
+# all the workers, where a merge step can pick them up.
+
+def parse_shard(shard_string):
+    """Turn a string like '2/8' (the third of eight shards) into (2, 8)."""
+    shard_index, shard_count = [int(x) for x in shard_string.split('/')]
+    if not 0 <= shard_index < shard_count:
+        raise ValueError("The shard index must be between 0 and {} (not {}).".format(shard_count-1, shard_index))
+    return shard_index, shard_count
+
+def in_shard(package_id, shard):
+    """Returns True if the package belongs to the shard (given as (shard_index,
+    shard_count)) or if there's no shard. An MD5 hash is used (rather than
+    Python's hash(), which is randomized for each process) so that every
+    worker agrees on the assignments."""
+    if shard is None:
+        return True
+    shard_index, shard_count = shard
+    return int(hashlib.md5(package_id.encode('utf-8')).hexdigest(), 16) % shard_count == shard_index
+
+def get_shard_path(shard_dir, name, shard):
+    return os.path.join(shard_dir, "{}_{}_of_{}.json".format(name, *shard))
+
+def store_shard(output, shard_dir, name, shard):
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_file = get_shard_path(shard_dir, name, shard)
+    with open(shard_file + '.tmp', 'w') as f:
+        json.dump(output, f, ensure_ascii=True, indent = 4)
+    os.replace(shard_file + '.tmp', shard_file) # So that the merge step never reads a partially written file.
+
+def load_shards(shard_dir, name, shard_count, run_id=None, max_age=None):
+    """Load the partial results of all the shards, raising a ValueError if any
+    are missing (since merging only some of them would make the packages in the
+    missing shards look like they are no longer stale). For the same reason,
+    shards left over from other runs are refused: those with a different
+    run_id (or, if no run_id is given, run_ids that don't all match) and those
+    generated longer than max_age (a timedelta) ago."""
+    shard_files = [get_shard_path(shard_dir, name, (k, shard_count)) for k in range(shard_count)]
+    missing = [f for f in shard_files if not os.path.exists(f)]
+    if len(missing) > 0:
+        raise ValueError("Unable to merge shards because these are missing: {}".format(', '.join(missing)))
+    shards = []
+    for shard_file in shard_files:
+        with open(shard_file, 'r') as f:
+            shards.append(json.load(f))
+
+    leftovers = []
+    run_ids = set(shard.get('run_id') for shard in shards)
+    for shard_file, shard in zip(shard_files, shards):
+        if run_id is not None and shard.get('run_id') != run_id:
+            leftovers.append("{} (run_id = {})".format(shard_file, shard.get('run_id')))
+        elif run_id is None and len(run_ids) > 1:
+            leftovers.append("{} (run_id = {}, but the shards have run_ids {})".format(shard_file, shard.get('run_id'), ', '.join(sorted(str(r) for r in run_ids))))
+        elif max_age is not None:
+            generated_at = datetime.fromisoformat(shard['generated_at'])
+            if generated_at.tzinfo is None or datetime.now(timezone.utc) - generated_at > max_age:
+                leftovers.append("{} (generated at {})".format(shard_file, shard['generated_at']))
+    if len(leftovers) > 0:
+        raise ValueError("Unable to merge shards because these are left over from other runs: {}".format(', '.join(leftovers)))
+    return shards